@@ -1,12 +1,17 @@
 import datetime
 import os
-import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 
 from config import (
     QUEUE_FILE, HISTORY_FILE,
     load_wissellijsten, get_history_file, get_queue_file,
 )
-from suggest import _parse_history_line, get_spotify_client
+from suggest import (
+    _parse_history_line, _format_history_line, _extract_decade,
+    get_spotify_client,
+)
 
 
 def get_decade(release_date):
@@ -18,23 +23,60 @@ def get_decade(release_date):
         return "Unknown"
 
 
-def _get_all_playlist_items(sp, playlist_id):
-    """Haal alle items uit een playlist op (met paginering)."""
-    items = []
-    result = sp.playlist_items(playlist_id, limit=100)
-    items.extend(result["items"])
-    while result.get("next"):
-        result = sp.next(result)
-        items.extend(result["items"])
-    return items
+def _chunks(items, size=100):
+    """Splits een lijst in stukken van max size (Spotify limiet per call)."""
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+# Alleen de velden die rotatie nodig heeft (scheelt veel payload per item)
+ROTATE_FIELDS = "items(added_at,track(uri,name,artists(name),album(release_date)))"
+
+# Max aantal pagina's dat tegelijk wordt opgehaald
+PAGE_WORKERS = 8
+
+
+def _iter_playlist_items(sp, playlist_id, fields=None):
+    """Loop over alle items van een playlist, pagina voor pagina.
+
+    De eerste pagina geeft het totaal; de overige pagina's worden daarna
+    parallel opgehaald en in volgorde doorgegeven. Er staan maximaal
+    PAGE_WORKERS pagina's tegelijk open, zodat een trage lezer niet de
+    hele playlist in het geheugen laat ophopen.
+
+    Args:
+        fields: Spotify fields-selector voor de items, bijv. 'items(added_at)'
+    """
+    page_fields = f"{fields},total" if fields else None
+
+    def fetch(offset):
+        return sp.playlist_items(playlist_id, fields=page_fields,
+                                 limit=100, offset=offset)
+
+    first = fetch(0)
+    yield from first["items"]
+    offsets = iter(range(100, first["total"], 100))
+    with ThreadPoolExecutor(max_workers=PAGE_WORKERS) as executor:
+        pending = deque(executor.submit(fetch, offset)
+                        for offset in islice(offsets, PAGE_WORKERS))
+        while pending:
+            page = pending.popleft().result()
+            for offset in islice(offsets, 1):
+                pending.append(executor.submit(fetch, offset))
+            yield from page["items"]
+
+
+def _get_all_playlist_items(sp, playlist_id, fields=None):
+    """Haal alle items uit een playlist op als lijst (zie _iter_playlist_items)."""
+    return list(_iter_playlist_items(sp, playlist_id, fields=fields))
 
 
 def _count_expired_tracks(sp, playlist_id, max_days=30):
     """Tel hoeveel tracks ouder zijn dan max_days in de playlist."""
-    items = _get_all_playlist_items(sp, playlist_id)
     now = datetime.datetime.now(datetime.timezone.utc)
     count = 0
-    for item in items:
+    for item in _iter_playlist_items(sp, playlist_id,
+                                     fields="items(added_at)"):
         added_at = item.get("added_at")
         if not added_at:
             continue
@@ -48,12 +90,13 @@ def _count_expired_tracks(sp, playlist_id, max_days=30):
 
 
 def rotate_playlist(playlist_id, queue_file=None, history_file=None,
-                    sort_by_age=False):
+                    sort_by_age=False, sp=None):
     """Verwijder de oudste nummers en voeg nieuwe toe uit de wachtrij.
 
     Args:
         sort_by_age: Als True, sorteer op added_at (oudste eerst) i.p.v.
                      playlist-positie. Gebruikt voor discovery.
+        sp: bestaande Spotify client (optioneel, anders wordt er een gemaakt)
     """
     queue_file = queue_file or QUEUE_FILE
     history_file = history_file or HISTORY_FILE
@@ -82,21 +125,24 @@ def rotate_playlist(playlist_id, queue_file=None, history_file=None,
         return {"status": "leeg", "tekst": "Wachtrij is leeg."}
 
     block_size = len(new_uris)
-    sp = get_spotify_client()
+    sp = sp or get_spotify_client()
 
     # Haal huidige playlist op
     if sort_by_age:
-        current_items = _get_all_playlist_items(sp, playlist_id)
+        current_items = _get_all_playlist_items(sp, playlist_id,
+                                                fields=ROTATE_FIELDS)
         # Sorteer op added_at (oudste eerst)
         current_items.sort(
             key=lambda x: x.get("added_at", "9999"),
         )
     else:
-        current_items = sp.playlist_items(playlist_id, limit=50)["items"]
+        current_items = sp.playlist_items(playlist_id, fields=ROTATE_FIELDS,
+                                          limit=50)["items"]
 
     # Log de te verwijderen tracks naar historie
     tracks_to_remove = []
     removed_tracks_detail = []
+    now = datetime.datetime.now(datetime.timezone.utc)
 
     with open(history_file, "a", encoding="utf-8") as hf:
         for item in current_items[:block_size]:
@@ -112,7 +158,7 @@ def rotate_playlist(playlist_id, queue_file=None, history_file=None,
                 try:
                     added_dt = datetime.datetime.fromisoformat(
                         added_at.replace("Z", "+00:00"))
-                    days_ago = (datetime.datetime.now(datetime.timezone.utc) - added_dt).days
+                    days_ago = (now - added_dt).days
                     print(f"  [discovery-remove] {artist} - {name} "
                           f"({days_ago} dagen oud)", flush=True)
                 except (ValueError, TypeError):
@@ -121,17 +167,21 @@ def rotate_playlist(playlist_id, queue_file=None, history_file=None,
             tracks_to_remove.append(uri)
             removed_tracks_detail.append({"artiest": artist, "titel": name})
 
-    # Verwijder oud, voeg nieuw toe
+    # Verwijder oud, voeg nieuw toe (Spotify max 100 per keer)
     if tracks_to_remove:
-        sp.playlist_remove_all_occurrences_of_items(playlist_id, tracks_to_remove)
-        sp.playlist_add_items(playlist_id, new_uris)
+        for chunk in _chunks(tracks_to_remove):
+            sp.playlist_remove_all_occurrences_of_items(playlist_id, chunk)
+        for chunk in _chunks(new_uris):
+            sp.playlist_add_items(playlist_id, chunk)
         print("Playlist succesvol geroteerd.")
 
     # Haal details op voor nieuwe tracks als die URI-only waren
     if new_uris and not new_tracks_detail:
         try:
-            tracks_info = sp.tracks(new_uris)
-            for t in tracks_info.get("tracks", []):
+            tracks_info = []
+            for chunk in _chunks(new_uris, 50):
+                tracks_info.extend(sp.tracks(chunk).get("tracks", []))
+            for t in tracks_info:
                 if t:
                     new_tracks_detail.append({
                         "artiest": t["artists"][0]["name"],
@@ -171,7 +221,10 @@ def _check_queue_decades(sp, queue_file):
 
     uris = [e["uri"] for e in entries]
     try:
-        tracks_info = sp.tracks(uris)["tracks"]
+        # Spotify max 50 tracks per call
+        tracks_info = []
+        for chunk in _chunks(uris, 50):
+            tracks_info.extend(sp.tracks(chunk)["tracks"])
     except Exception as exc:
         print(f"  [decade-check] Kon tracks niet ophalen: {exc}", flush=True)
         return
@@ -184,8 +237,7 @@ def _check_queue_decades(sp, queue_file):
         actual_decade = get_decade(release_date)
 
         # Haal verwacht decennium uit de categorienaam (bijv. "80s" uit "80s heeft in de...")
-        match = re.match(r'(\d{2}s)', entry["categorie"])
-        expected = match.group(1) if match else None
+        expected = _extract_decade(entry["categorie"])
 
         artist = entry["artiest"]
         title = entry["titel"]
@@ -229,7 +281,7 @@ def rotate_and_regenerate(wl):
 
     # Stap 1: Roteer
     result = rotate_playlist(wl["playlist_id"], queue_file=queue_file,
-                             history_file=history_file)
+                             history_file=history_file, sp=sp)
 
     if result["status"] == "leeg":
         return result
@@ -237,18 +289,19 @@ def rotate_and_regenerate(wl):
     # Stap 2: Genereer nieuw blokje voor de wachtrij
     block = None
     max_retries = 3
+    search_cache = {}
     for _ in range(max_retries):
         block = generate_block(sp, wl["playlist_id"],
                                wl.get("categorieen", []),
                                history_file=history_file,
-                               max_per_artiest=wl.get("max_per_artiest", 0))
+                               max_per_artiest=wl.get("max_per_artiest", 0),
+                               search_cache=search_cache)
         if block:
             break
 
     if block:
         with open(queue_file, "w", encoding="utf-8") as f:
-            for t in block:
-                f.write(f"{t['categorie']} - {t['artiest']} - {t['titel']} - {t['uri']}\n")
+            f.writelines(_format_history_line(t) for t in block)
         result["nieuw_blok"] = True
     else:
         result["nieuw_blok"] = False
@@ -298,16 +351,15 @@ def _rotate_discovery(wl, queue_file, history_file):
 
     # Stap 2: Schrijf naar wachtrij
     with open(queue_file, "w", encoding="utf-8") as f:
-        for t in block:
-            f.write(f"{t['categorie']} - {t['artiest']} - "
-                    f"{t['titel']} - {t['uri']}\n")
+        f.writelines(_format_history_line(t) for t in block)
     print(f"[discovery-rotate] Stap 2: {len(block)} tracks in wachtrij",
           flush=True)
 
     # Stap 3: Roteer (sort_by_age=True: oudste op added_at eerst)
     print(f"[discovery-rotate] Stap 3: Roteren (oudste eerst)...", flush=True)
     result = rotate_playlist(wl["playlist_id"], queue_file=queue_file,
-                             history_file=history_file, sort_by_age=True)
+                             history_file=history_file, sort_by_age=True,
+                             sp=sp)
     result["nieuw_blok"] = True
     return result
 
@@ -323,9 +375,10 @@ if __name__ == "__main__":
             exit(1)
         rotate_playlist(playlist_id)
     else:
+        sp = get_spotify_client()
         for wl in data["wissellijsten"]:
             print(f"Roteer: {wl['naam']}...")
             queue_file = get_queue_file(wl["id"])
             history_file = get_history_file(wl["id"])
             rotate_playlist(wl["playlist_id"], queue_file=queue_file,
-                            history_file=history_file)
+                            history_file=history_file, sp=sp)
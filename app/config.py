@@ -9,6 +9,8 @@ SPOTIFY_CLIENT_ID = os.environ["SPOTIFY_CLIENT_ID"]
 SPOTIFY_CLIENT_SECRET = os.environ["SPOTIFY_CLIENT_SECRET"]
 SPOTIFY_REDIRECT_URI = os.getenv("SPOTIFY_REDIRECT_URI", "http://127.0.0.1:8888/callback")
 SPOTIFY_SCOPE = "playlist-read-private playlist-modify-public playlist-modify-private user-top-read"
+# Max Spotify API calls per seconde, gedeeld over alle taken (0 = geen limiet)
+SPOTIFY_RATE_LIMIT = float(os.getenv("SPOTIFY_RATE_LIMIT", "10"))
 
 # OpenAI
 OPENAI_API_KEY = os.environ["OPENAI_API_KEY"]
@@ -27,6 +29,7 @@ HISTORY_FILE = os.path.join(DATA_DIR, "historie.txt")
 SUGGESTIONS_FILE = os.path.join(DATA_DIR, "aanbevelingen.txt")
 CACHE_PATH = os.path.join(DATA_DIR, ".cache")
 CONFIG_FILE = os.path.join(DATA_DIR, "wissellijsten.json")
+SOURCE_CACHE_DIR = os.path.join(DATA_DIR, "bron_cache")
 
 
 def load_wissellijsten():
@@ -63,6 +66,11 @@ def get_queue_file(lijst_id):
     return os.path.join(DATA_DIR, f"wachtrij_{lijst_id}.txt")
 
 
+def get_source_cache_file(playlist_id):
+    """Geef het pad naar de cache van een bronlijst (discovery)."""
+    return os.path.join(SOURCE_CACHE_DIR, f"{playlist_id}.json")
+
+
 def get_smaakprofiel_file(lijst_id):
     """Geef het pad naar het smaakprofiel-bestand voor een specifieke wissellijst."""
     return os.path.join(DATA_DIR, f"smaakprofiel_{lijst_id}.txt")
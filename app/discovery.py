@@ -2,12 +2,21 @@
 """Discovery wissellijst: scan bronlijsten, bouw smaakprofiel, score met GPT."""
 import os
 import json
+import functools
+import tempfile
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from openai import OpenAI
-from config import OPENAI_API_KEY
+from config import OPENAI_API_KEY, get_source_cache_file
+from automation import _get_all_playlist_items, _iter_playlist_items
+from suggest import _format_history_line
 
 client = OpenAI(api_key=OPENAI_API_KEY)
 
+# Max aantal bronlijsten dat tegelijk wordt opgehaald
+SCAN_WORKERS = 8
+
 
 def build_taste_profile(sp):
     """Bouw een smaakprofiel op basis van Spotify luistergedrag.
@@ -34,12 +43,9 @@ def build_taste_profile(sp):
         top_tracks = []
 
     # Genres verzamelen en tellen
-    all_genres = {}
-    for a in top_artists_medium:
-        for g in a.get('genres', []):
-            all_genres[g] = all_genres.get(g, 0) + 1
-    sorted_genres = sorted(all_genres.items(), key=lambda x: -x[1])
-    top_genres = [g for g, _ in sorted_genres[:20]]
+    all_genres = Counter(g for a in top_artists_medium
+                         for g in a.get('genres', []))
+    top_genres = [g for g, _ in all_genres.most_common(20)]
 
     # Artiest namen
     medium_artists = [a['name'] for a in top_artists_medium[:25]]
@@ -68,29 +74,95 @@ def build_taste_profile(sp):
     return '\n'.join(profile_parts)
 
 
+def _read_source_cache(pid, snapshot_id):
+    """Lees gecachte items van een bronlijst als de snapshot nog klopt."""
+    cache_file = get_source_cache_file(pid)
+    if not os.path.exists(cache_file):
+        return None
+    try:
+        with open(cache_file, 'r', encoding='utf-8') as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if cached.get('snapshot_id') != snapshot_id:
+        return None
+    return cached.get('items')
+
+
+def _write_source_cache(pid, snapshot_id, items):
+    """Sla items van een bronlijst op, gekoppeld aan de snapshot_id."""
+    cache_file = get_source_cache_file(pid)
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    # Eigen tmp-bestand per schrijver: parallelle runs kunnen dezelfde
+    # bronlijst tegelijk ophalen
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(cache_file),
+                                    suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump({'snapshot_id': snapshot_id, 'items': items}, f,
+                      ensure_ascii=False)
+        os.replace(tmp_file, cache_file)
+    except BaseException:
+        os.remove(tmp_file)
+        raise
+
+
+def _fetch_source_playlist(sp, pid):
+    """Haal naam en alle tracks van één bronlijst op.
+
+    Zolang de snapshot_id van de playlist niet verandert, komen de tracks
+    uit de cache in DATA_DIR en is er maar één (kleine) API call nodig.
+
+    Returns: (playlist_name, items)
+    """
+    playlist_info = sp.playlist(pid, fields='name,snapshot_id')
+    playlist_name = playlist_info['name']
+    snapshot_id = playlist_info.get('snapshot_id')
+
+    if snapshot_id:
+        items = _read_source_cache(pid, snapshot_id)
+        if items is not None:
+            return playlist_name, items
+
+    items = _get_all_playlist_items(
+        sp, pid,
+        fields='items(track(uri,name,artists(name),album(name,release_date)))',
+    )
+
+    if snapshot_id:
+        try:
+            _write_source_cache(pid, snapshot_id, items)
+        except OSError as e:
+            print(f"  Kon bronlijst-cache niet schrijven voor {pid}: {e}",
+                  flush=True)
+    return playlist_name, items
+
+
 def scan_source_playlists(sp, playlist_ids):
     """Scan bronlijsten en tel overlap.
 
+    Bronlijsten worden parallel opgehaald (max SCAN_WORKERS tegelijk) en
+    daarna in de opgegeven volgorde samengevoegd.
+
     Returns: dict van URI -> {artiest, titel, album, uri, overlap, bronnen}
     """
     tracks_map = {}
-
-    for idx, pid in enumerate(playlist_ids, 1):
-        try:
-            # Haal naam en tracks in 1 call via playlist_items (met naam uit eerste call)
-            results = sp.playlist_items(
-                pid,
-                fields='items(track(uri,name,artists(name),album(name,release_date))),next',
-                limit=100,
-            )
-            items = list(results['items'])
-            while results.get('next'):
-                results = sp.next(results)
-                items.extend(results['items'])
-
-            # Naam ophalen via playlist (alleen 'name' field, minimale data)
-            playlist_info = sp.playlist(pid, fields='name')
-            playlist_name = playlist_info['name']
+    # Dubbel geconfigureerde bronlijsten maar één keer ophalen (en tellen)
+    playlist_ids = list(dict.fromkeys(playlist_ids))
+    if not playlist_ids:
+        return tracks_map
+
+    workers = min(SCAN_WORKERS, len(playlist_ids))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_fetch_source_playlist, sp, pid)
+                   for pid in playlist_ids]
+
+        for idx, (pid, future) in enumerate(zip(playlist_ids, futures), 1):
+            try:
+                playlist_name, items = future.result()
+            except Exception as e:
+                print(f"Fout bij scannen playlist {pid}: {e}", flush=True)
+                continue
 
             print(f"  [{idx}/{len(playlist_ids)}] {playlist_name}: "
                   f"{len(items)} tracks", flush=True)
@@ -122,16 +194,23 @@ def scan_source_playlists(sp, playlist_ids):
                         'overlap': 1,
                         'bronnen': [playlist_name],
                     }
-        except Exception as e:
-            print(f"Fout bij scannen playlist {pid}: {e}", flush=True)
 
     print(f"  Totaal: {len(tracks_map)} unieke tracks uit "
           f"{len(playlist_ids)} bronlijsten", flush=True)
     return tracks_map
 
 
-def _is_recent_release(release_date, max_months=3):
-    """Check of een track binnen de laatste max_months maanden is uitgebracht."""
+def _release_cutoff(max_months=3):
+    """Geef de vroegste releasedatum die nog als recent telt."""
+    return datetime.now() - timedelta(days=max_months * 30)
+
+
+def _is_recent_release(release_date, max_months=3, cutoff=None):
+    """Check of een track binnen de laatste max_months maanden is uitgebracht.
+
+    Args:
+        cutoff: vooraf berekende _release_cutoff() (bij gebruik in een loop)
+    """
     if not release_date:
         return False
     try:
@@ -144,22 +223,52 @@ def _is_recent_release(release_date, max_months=3):
             # Alleen jaar - neem 1 januari
             release = datetime(int(parts[0]), 1, 1)
 
-        cutoff = datetime.now() - timedelta(days=max_months * 30)
+        if cutoff is None:
+            cutoff = _release_cutoff(max_months)
         return release >= cutoff
     except (ValueError, IndexError):
         return False
 
 
+def _filter_candidates(all_tracks, used_uris):
+    """Filter gebruikte en te oude tracks in één pass over de bronlijst-tracks.
+
+    Returns: (candidates, unused_count) waar unused_count het aantal tracks
+             is dat niet eerder gebruikt is (vóór het release filter).
+    """
+    candidates = []
+    unused_count = 0
+    cutoff = _release_cutoff()
+    for t in all_tracks.values():
+        if t['uri'] in used_uris:
+            continue
+        unused_count += 1
+        if _is_recent_release(t.get('release_date', ''), cutoff=cutoff):
+            candidates.append(t)
+    return candidates, unused_count
+
+
 def _load_history_uris(history_file):
-    """Lees historie en return set van URIs."""
+    """Lees historie en return frozenset van URIs.
+
+    Gecached zolang het bestand niet wijzigt (mtime + grootte).
+    """
+    if not history_file or not os.path.exists(history_file):
+        return frozenset()
+    st = os.stat(history_file)
+    return _read_history_uris(history_file, st.st_mtime_ns, st.st_size)
+
+
+@functools.lru_cache(maxsize=32)
+def _read_history_uris(history_file, mtime_ns, size):
+    """Parse het historie-bestand; mtime_ns en size dienen als cache key."""
     uris = set()
-    if history_file and os.path.exists(history_file):
-        with open(history_file, 'r', encoding='utf-8') as f:
-            for line in f:
-                parts = line.strip().rsplit(' - ', 1)
-                if len(parts) == 2 and parts[1].startswith('spotify:'):
-                    uris.add(parts[1])
-    return uris
+    with open(history_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            parts = line.strip().rsplit(' - ', 1)
+            if len(parts) == 2 and parts[1].startswith('spotify:'):
+                uris.add(parts[1])
+    return frozenset(uris)
 
 
 def _load_queue_uris(queue_file):
@@ -184,19 +293,10 @@ def _load_playlist_uris(sp, playlist_id):
     """Haal alle URIs op uit een Spotify playlist."""
     uris = set()
     try:
-        results = sp.playlist_items(
-            playlist_id,
-            fields='items(track(uri)),next',
-            limit=100,
-        )
-        for item in results['items']:
+        for item in _iter_playlist_items(sp, playlist_id,
+                                         fields='items(track(uri))'):
             if item.get('track') and item['track'].get('uri'):
                 uris.add(item['track']['uri'])
-        while results.get('next'):
-            results = sp.next(results)
-            for item in results['items']:
-                if item.get('track') and item['track'].get('uri'):
-                    uris.add(item['track']['uri'])
     except Exception:
         pass
     return uris
@@ -323,16 +423,16 @@ def rank_and_select(candidates, scores, count=10, max_per_artiest=0):
 
     # Selecteer met optionele artiest-limiet
     selected = []
-    artiest_count = {}
+    artiest_count = Counter()
 
     for track in ranked:
         artiest = track['artiest']
         if max_per_artiest > 0:
-            if artiest_count.get(artiest, 0) >= max_per_artiest:
+            if artiest_count[artiest] >= max_per_artiest:
                 continue
 
         selected.append(track)
-        artiest_count[artiest] = artiest_count.get(artiest, 0) + 1
+        artiest_count[artiest] += 1
 
         if len(selected) >= count:
             break
@@ -388,17 +488,13 @@ def generate_discovery_block(sp, wl, history_file, block_size=10):
     queue_uris = _load_queue_uris(get_queue_file(wl['id']))
     used_uris = history_uris | playlist_uris | queue_uris
 
-    candidates = [t for t in all_tracks.values() if t['uri'] not in used_uris]
-    print(f"[discovery] Stap 2: {len(candidates)} kandidaten na filter "
+    # Inclusief filter op recente releases (laatste 3 maanden)
+    candidates, unused_count = _filter_candidates(all_tracks, used_uris)
+    print(f"[discovery] Stap 2: {unused_count} kandidaten na filter "
           f"(historie={len(history_uris)}, playlist={len(playlist_uris)}, "
           f"wachtrij={len(queue_uris)})", flush=True)
-
-    # Filter op recente releases (laatste 3 maanden)
-    pre_count = len(candidates)
-    candidates = [t for t in candidates
-                  if _is_recent_release(t.get('release_date', ''))]
     print(f"[discovery] Stap 2b: {len(candidates)} kandidaten na release "
-          f"filter ({pre_count - len(candidates)} te oud)", flush=True)
+          f"filter ({unused_count - len(candidates)} te oud)", flush=True)
 
     if not candidates:
         print("[discovery] Geen nieuwe tracks gevonden in bronlijsten",
@@ -462,7 +558,6 @@ def initial_fill_discovery(playlist_id, wl, history_file, queue_file,
     import time
     t_start = time.time()
 
-    sp = get_spotify_client()
     source_ids = wl.get('bron_playlists', [])
     max_per_artiest = wl.get('max_per_artiest', 0)
 
@@ -479,6 +574,16 @@ def initial_fill_discovery(playlist_id, wl, history_file, queue_file,
     block_size = wl.get('blok_grootte', 10)
     totaal = aantal_blokken + 1  # +1 voor wachtrij
 
+    # Niets te doen zonder bronlijsten: geen Spotify/GPT calls
+    if not source_ids:
+        print("[discovery-fill] Geen bronlijsten geconfigureerd", flush=True)
+        return {
+            "toegevoegd": 0, "blokken": 0,
+            "mislukt": totaal, "wachtrij_klaar": False,
+        }
+
+    sp = get_spotify_client()
+
     print(f"[discovery-fill] Start: {len(source_ids)} bronlijsten, "
           f"{aantal_blokken} blokken x {block_size} tracks", flush=True)
 
@@ -493,16 +598,12 @@ def initial_fill_discovery(playlist_id, wl, history_file, queue_file,
     playlist_uris = _load_playlist_uris(sp, playlist_id)
     used_uris = history_uris | playlist_uris
 
-    candidates = [t for t in all_tracks.values() if t['uri'] not in used_uris]
-    print(f"[discovery-fill] {len(candidates)} kandidaten na filter "
+    # Inclusief filter op recente releases (laatste 3 maanden)
+    candidates, unused_count = _filter_candidates(all_tracks, used_uris)
+    print(f"[discovery-fill] {unused_count} kandidaten na filter "
           f"({len(used_uris)} al gebruikt)", flush=True)
-
-    # Filter op recente releases (laatste 3 maanden)
-    pre_count = len(candidates)
-    candidates = [t for t in candidates
-                  if _is_recent_release(t.get('release_date', ''))]
     print(f"[discovery-fill] {len(candidates)} kandidaten na release filter "
-          f"({pre_count - len(candidates)} te oud)", flush=True)
+          f"({unused_count - len(candidates)} te oud)", flush=True)
 
     if not candidates:
         return {
@@ -567,22 +668,14 @@ def initial_fill_discovery(playlist_id, wl, history_file, queue_file,
 
         if is_wachtrij:
             with open(queue_file, "w", encoding="utf-8") as f:
-                for t in block:
-                    f.write(
-                        f"{t['categorie']} - {t['artiest']} - "
-                        f"{t['titel']} - {t['uri']}\n"
-                    )
+                f.writelines(_format_history_line(t) for t in block)
         else:
             uris = [t['uri'] for t in block]
             sp.playlist_add_items(playlist_id, uris)
             alle_tracks_added.extend(block)
 
             with open(history_file, "a", encoding="utf-8") as hf:
-                for t in block:
-                    hf.write(
-                        f"{t['categorie']} - {t['artiest']} - "
-                        f"{t['titel']} - {t['uri']}\n"
-                    )
+                hf.writelines(_format_history_line(t) for t in block)
 
     elapsed = time.time() - t_start
     blokken_ok = len(alle_tracks_added) // block_size if block_size else 0
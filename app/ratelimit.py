@@ -0,0 +1,40 @@
+"""Leaky-bucket rate limiter voor Spotify API calls."""
+import threading
+import time
+
+import requests
+
+
+class LeakyBucket:
+    """Laat maximaal `rate` calls per seconde door, gedeeld over threads.
+
+    Elke call krijgt een eigen tijdslot; wie te vroeg is wacht tot zijn slot.
+    Een rate van 0 (of lager) schakelt de limiter uit.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+
+    def acquire(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+class RateLimitedSession(requests.Session):
+    """requests.Session die elke request eerst langs de limiter stuurt."""
+
+    def __init__(self, limiter):
+        super().__init__()
+        self.limiter = limiter
+
+    def request(self, *args, **kwargs):
+        self.limiter.acquire()
+        return super().request(*args, **kwargs)
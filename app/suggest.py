@@ -1,28 +1,120 @@
 # -*- coding: utf-8 -*-
 import spotipy
+from spotipy.cache_handler import CacheFileHandler
 from spotipy.oauth2 import SpotifyOAuth
 from openai import OpenAI
 
 from config import (
     SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET, SPOTIFY_REDIRECT_URI,
-    SPOTIFY_SCOPE, CACHE_PATH,
+    SPOTIFY_SCOPE, SPOTIFY_RATE_LIMIT, CACHE_PATH,
     OPENAI_API_KEY, HISTORY_FILE, SUGGESTIONS_FILE, QUEUE_FILE,
 )
+from ratelimit import LeakyBucket, RateLimitedSession
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import json
+import logging
 import os
 import re
+import tempfile
+import threading
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+# Eén gedeelde sessie, zodat alle taken samen onder de rate limit blijven.
+# Met een eigen sessie mount spotipy zijn retry-adapter niet, dus doen we
+# dat hier (zelfde retry-gedrag als spotipy, incl. Retry-After bij 429) met
+# een grotere connection pool voor de parallelle calls.
+_spotify_session = RateLimitedSession(LeakyBucket(SPOTIFY_RATE_LIMIT))
+_spotify_adapter = HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=20,
+    max_retries=Retry(
+        total=3,
+        connect=None,
+        read=False,
+        status=3,
+        backoff_factor=0.3,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset(["GET", "POST", "PUT", "DELETE"]),
+    ),
+)
+_spotify_session.mount("https://", _spotify_adapter)
+_spotify_session.mount("http://", _spotify_adapter)
+
+# Eén Spotify client per proces (hergebruikt auth manager en keep-alive sessie)
+_sp_client = None
+_sp_lock = threading.Lock()
+
+# Token cache: lezen/schrijven onder één lock (ook tussen auth managers),
+# verversen door één thread tegelijk
+_token_cache_lock = threading.Lock()
+_token_refresh_lock = threading.Lock()
+
+
+class LockedCacheFileHandler(CacheFileHandler):
+    """CacheFileHandler met lock en atomisch schrijven (tmp-bestand + replace).
+
+    Spotipy schrijft de cache met open(path, "w"); een thread die tegelijk
+    leest krijgt dan een half bestand en een JSONDecodeError.
+    """
+
+    def get_cached_token(self):
+        with _token_cache_lock:
+            return super().get_cached_token()
+
+    def save_token_to_cache(self, token_info):
+        with _token_cache_lock:
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(self.cache_path) or ".")
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump(token_info, f, cls=self.encoder_cls)
+                os.replace(tmp_path, self.cache_path)
+            except OSError as e:
+                print(f"[auth] Token cache schrijven mislukt: {e}", flush=True)
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+
+class SerialSpotifyOAuth(SpotifyOAuth):
+    """SpotifyOAuth waarbij maar één thread tegelijk de token valideert en
+    ververst; de andere threads krijgen daarna de verse token uit de cache.
+
+    Elke API call loopt via get_access_token -> validate_token, dus zonder
+    lock ververst bij een verlopen token elke parallelle thread tegelijk.
+    """
+
+    def validate_token(self, token_info):
+        with _token_refresh_lock:
+            if token_info and self.is_token_expired(token_info):
+                # Misschien heeft een andere thread net ververst
+                token_info = self.cache_handler.get_cached_token() or token_info
+            return super().validate_token(token_info)
 
 
 def get_spotify_client():
-    auth_manager = SpotifyOAuth(
-        client_id=SPOTIFY_CLIENT_ID,
-        client_secret=SPOTIFY_CLIENT_SECRET,
-        redirect_uri=SPOTIFY_REDIRECT_URI,
-        scope=SPOTIFY_SCOPE,
-        cache_path=CACHE_PATH,
-        open_browser=False,
-    )
-    # Check of er een geldige (of refreshbare) token is
-    token_info = auth_manager.get_cached_token()
+    global _sp_client
+    with _sp_lock:
+        if _sp_client is None:
+            auth_manager = SerialSpotifyOAuth(
+                client_id=SPOTIFY_CLIENT_ID,
+                client_secret=SPOTIFY_CLIENT_SECRET,
+                redirect_uri=SPOTIFY_REDIRECT_URI,
+                scope=SPOTIFY_SCOPE,
+                cache_handler=LockedCacheFileHandler(cache_path=CACHE_PATH),
+                open_browser=False,
+            )
+            _sp_client = spotipy.Spotify(auth_manager=auth_manager,
+                                         requests_session=_spotify_session)
+        sp = _sp_client
+
+        # Check of er een geldige (of refreshbare) token is. De auth manager
+        # leest de cache elke keer opnieuw, dus een nieuwe login via /callback
+        # telt mee.
+        token_info = sp.auth_manager.get_cached_token()
+
     if not token_info:
         raise Exception("auth_required")
 
@@ -31,12 +123,15 @@ def get_spotify_client():
     required_scopes = set(SPOTIFY_SCOPE.split())
     if not required_scopes.issubset(cached_scopes):
         # Scopes gewijzigd - verwijder oude token
-        import os
         if os.path.exists(CACHE_PATH):
             os.remove(CACHE_PATH)
         raise Exception("auth_required")
 
-    return spotipy.Spotify(auth_manager=auth_manager)
+    return sp
+
+
+# Losse aanhalingstekens openen een frase in de Spotify zoekquery
+_QUOTE_RE = re.compile(r'["\\]')
 
 
 def search_spotify(sp, artist, title):
@@ -52,6 +147,9 @@ def search_spotify(sp, artist, title):
             "release_date": track.get("album", {}).get("release_date", ""),
         }
 
+    artist = _QUOTE_RE.sub("", artist)
+    title = _QUOTE_RE.sub("", title)
+
     # Strikte zoekopdracht
     results = sp.search(q=f"track:{title} artist:{artist}", limit=1, type="track")
     tracks = results.get("tracks", {}).get("items", [])
@@ -90,27 +188,28 @@ def _parse_history_line(line):
     }
 
 
+def _format_history_line(t):
+    """Formatteer een track dict als historie/wachtrij-regel (zie _parse_history_line)."""
+    return f"{t['categorie']} - {t['artiest']} - {t['titel']} - {t['uri']}\n"
+
+
 def load_history(history_file=None):
     """Laad artiesten en URI's uit de historie.
 
-    Returns: (artists, uris, artist_counts) waar artist_counts een dict is
-             met per artiest het aantal keer dat die voorkomt.
+    Returns: (artists, uris)
     """
     history_file = history_file or HISTORY_FILE
     artists = []
     uris = []
-    artist_counts = {}
     if os.path.exists(history_file):
         with open(history_file, "r", encoding="utf-8") as f:
             for line in f:
                 parsed = _parse_history_line(line)
                 if not parsed:
                     continue
-                artist = parsed["artiest"]
-                artists.append(artist)
+                artists.append(parsed["artiest"])
                 uris.append(parsed["uri"])
-                artist_counts[artist] = artist_counts.get(artist, 0) + 1
-    return artists, uris, artist_counts
+    return artists, uris
 
 
 def ask_gpt_for_suggestions(categorieen, exclude_artists, blocked_artists=None, per_categorie=5):
@@ -158,13 +257,16 @@ def ask_gpt_for_suggestions(categorieen, exclude_artists, blocked_artists=None,
     return response.choices[0].message.content.strip().split("\n")
 
 
+_DECADE_RE = re.compile(r'(\d{2}s)')
+
+
 def _extract_decade(category):
     """Haal decennium (bijv. '80s') uit een categorienaam.
 
     Werkt voor '80s', '80s heeft in de top 40', etc.
     Returns: decade string of None als geen decennium in de categorie zit.
     """
-    match = re.match(r'(\d{2}s)', category)
+    match = _DECADE_RE.match(category)
     return match.group(1) if match else None
 
 
@@ -177,20 +279,33 @@ def _get_decade(release_date):
         return None
 
 
-def _match_categorie(raw_cat, categorieen, filled):
+_NUMBERING_RE = re.compile(r'^\d+[\.\)]\s*')
+
+
+def _categorie_keys(categorieen):
+    """Normaliseer de categorieën eenmalig voor _match_categorie.
+
+    Returns: lijst van (categorie, categorie_lower) tuples.
+    """
+    return [(cat, cat.lower().strip()) for cat in categorieen]
+
+
+def _match_categorie(raw_cat, categorie_keys, filled):
     """Match een GPT-categorie aan de originele categorieën.
 
     Probeert exact, dan case-insensitive, dan substring matching.
     Skipt categorieën die al gevuld zijn.
+
+    Args:
+        categorie_keys: uitvoer van _categorie_keys(categorieen)
     """
     raw_lower = raw_cat.lower().strip()
     # Verwijder eventuele nummering (bijv. "1. 80s" -> "80s")
-    raw_clean = re.sub(r'^\d+[\.\)]\s*', '', raw_lower)
+    raw_clean = _NUMBERING_RE.sub('', raw_lower)
 
-    for cat in categorieen:
+    for cat, cat_lower in categorie_keys:
         if cat in filled:
             continue
-        cat_lower = cat.lower().strip()
         if cat_lower == raw_clean or cat_lower == raw_lower:
             return cat
         if cat_lower in raw_clean or raw_clean in cat_lower:
@@ -198,7 +313,8 @@ def _match_categorie(raw_cat, categorieen, filled):
     return None
 
 
-def generate_block(sp, playlist_id, categorieen, history_file=None, max_per_artiest=0):
+def generate_block(sp, playlist_id, categorieen, history_file=None, max_per_artiest=0,
+                   search_cache=None):
     """Genereer één blok suggesties (1 per categorie), gevalideerd op Spotify.
 
     Vraagt GPT om meerdere alternatieven per categorie en kiest de eerste
@@ -206,28 +322,46 @@ def generate_block(sp, playlist_id, categorieen, history_file=None, max_per_arti
 
     Args:
         max_per_artiest: max nummers per artiest (0 = onbeperkt)
+        search_cache: optionele dict die Spotify-zoekresultaten deelt tussen
+            aanroepen binnen één run (retries en volgende blokken)
 
     Returns: lijst van dicts met {categorie, artiest, titel, uri} of None bij fout.
     """
+    if not categorieen:
+        print("  [block] Geen categorieën geconfigureerd", flush=True)
+        return None
+
+    if search_cache is None:
+        search_cache = {}
+
     history_file = history_file or HISTORY_FILE
 
     # Verzamel artiesten om te vermijden
-    current_tracks = sp.playlist_items(playlist_id)["items"]
+    current_tracks = sp.playlist_items(
+        playlist_id, fields="items(track(uri,artists(name)))")["items"]
     active_artists = [t["track"]["artists"][0]["name"] for t in current_tracks if t.get("track")]
-    history_artists, history_uris, artist_counts = load_history(history_file)
+    active_uris = {t["track"]["uri"] for t in current_tracks
+                   if t.get("track") and t["track"].get("uri")}
+    history_artists, history_uris = load_history(history_file)
 
-    # Tel ook artiesten in huidige playlist mee
-    for a in active_artists:
-        artist_counts[a] = artist_counts.get(a, 0) + 1
+    # Tel per artiest (hoofdletterongevoelig: GPT schrijft namen soms anders),
+    # inclusief de artiesten in de huidige playlist
+    known_artists = history_artists + active_artists
+    artist_counts = Counter(a.casefold() for a in known_artists)
 
-    # Artiesten die het max bereikt hebben uitsluiten
+    # Artiesten die het max bereikt hebben uitsluiten (met hun eigen schrijfwijze)
     if max_per_artiest > 0:
-        blocked_artists = [a for a, c in artist_counts.items() if c >= max_per_artiest]
+        blocked_artists = list(dict.fromkeys(
+            a for a in known_artists
+            if artist_counts[a.casefold()] >= max_per_artiest
+        ))
     else:
         blocked_artists = []
 
-    # Stuur geblokkeerde artiesten apart (strenger) en rest als gewone exclude
-    exclude = list(set(active_artists + history_artists[-50:]))
+    # Stuur geblokkeerde artiesten apart (strenger) en rest als gewone exclude.
+    # dict.fromkeys ontdubbelt met behoud van volgorde, zodat de [:60] afkapping
+    # in de prompt de playlist-artiesten voorrang geeft.
+    exclude = list(dict.fromkeys(active_artists + history_artists[-50:]))
 
     raw_suggestions = ask_gpt_for_suggestions(
         categorieen, exclude,
@@ -236,7 +370,10 @@ def generate_block(sp, playlist_id, categorieen, history_file=None, max_per_arti
     )
 
     filled = {}  # categorie -> result dict
-    used_uris = set(history_uris)
+    # Eén set voor alles wat al gebruikt is: historie + huidige playlist
+    used_uris = set(history_uris) | active_uris
+    categorie_keys = _categorie_keys(categorieen)
+    expected_decades = {c: _extract_decade(c) for c in categorieen}
 
     for line in raw_suggestions:
         if "|" not in line:
@@ -250,36 +387,45 @@ def generate_block(sp, playlist_id, categorieen, history_file=None, max_per_arti
         title = parts[2].strip()
 
         # Match aan originele categorie (skip al gevulde)
-        matched_cat = _match_categorie(raw_cat, categorieen, filled)
+        matched_cat = _match_categorie(raw_cat, categorie_keys, filled)
         if not matched_cat:
             continue
 
         # Check max per artiest
-        if max_per_artiest > 0 and artist_counts.get(artist, 0) >= max_per_artiest:
-            print(f"  [block] Skip {artist} - {title}: artiest op max ({max_per_artiest})",
-                  flush=True)
+        artist_key = artist.casefold()
+        if max_per_artiest > 0 and artist_counts[artist_key] >= max_per_artiest:
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"  [block] Skip {artist} - {title}: "
+                             f"artiest op max ({max_per_artiest})")
             continue
 
-        result = search_spotify(sp, artist, title)
+        key = (artist, title)
+        if key in search_cache:
+            result = search_cache[key]
+        else:
+            result = search_cache[key] = search_spotify(sp, artist, title)
         if not result:
-            print(f"  [block] Skip {artist} - {title}: niet gevonden op Spotify",
-                  flush=True)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"  [block] Skip {artist} - {title}: "
+                             f"niet gevonden op Spotify")
             continue
         uri = result["uri"]
         release_date = result["release_date"]
         if uri in used_uris:
-            print(f"  [block] Skip {artist} - {title}: al in historie",
-                  flush=True)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"  [block] Skip {artist} - {title}: "
+                             f"al in historie of playlist")
             continue
 
         # Decade check: klopt het releasejaar bij de gevraagde categorie?
-        expected_decade = _extract_decade(matched_cat)
+        expected_decade = expected_decades[matched_cat]
         if expected_decade and release_date:
             actual_decade = _get_decade(release_date)
             if actual_decade and actual_decade != expected_decade:
-                print(f"  [block] Skip {artist} - {title}: "
-                      f"release {release_date} ({actual_decade}) past niet bij {expected_decade}",
-                      flush=True)
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(f"  [block] Skip {artist} - {title}: "
+                                 f"release {release_date} ({actual_decade}) "
+                                 f"past niet bij {expected_decade}")
                 continue
 
         filled[matched_cat] = {
@@ -290,7 +436,7 @@ def generate_block(sp, playlist_id, categorieen, history_file=None, max_per_arti
         }
         used_uris.add(uri)
         # Update count voor dit blok
-        artist_counts[artist] = artist_counts.get(artist, 0) + 1
+        artist_counts[artist_key] += 1
         print(f"  [block] {matched_cat}: {artist} - {title} ✓", flush=True)
 
         # Stop vroeg als alles gevuld is
@@ -352,6 +498,8 @@ def initial_fill(playlist_id, categorieen, history_file=None, queue_file=None,
     mislukt = 0
     max_retries = 3
     totaal = nog_te_vullen + 1  # +1 voor wachtrij
+    # GPT stelt bij retries en volgende blokken vaak dezelfde nummers voor
+    search_cache = {}
 
     for blok_nr in range(1, totaal + 1):
         is_wachtrij = blok_nr == totaal
@@ -364,7 +512,8 @@ def initial_fill(playlist_id, categorieen, history_file=None, queue_file=None,
         block = None
         for poging in range(max_retries):
             block = generate_block(sp, playlist_id, categorieen, history_file,
-                                   max_per_artiest=max_per_artiest)
+                                   max_per_artiest=max_per_artiest,
+                                   search_cache=search_cache)
             if block:
                 break
 
@@ -375,8 +524,7 @@ def initial_fill(playlist_id, categorieen, history_file=None, queue_file=None,
         if is_wachtrij:
             # Laatste blok gaat naar de wachtrij (volledig formaat)
             with open(queue_file, "w", encoding="utf-8") as f:
-                for t in block:
-                    f.write(f"{t['categorie']} - {t['artiest']} - {t['titel']} - {t['uri']}\n")
+                f.writelines(_format_history_line(t) for t in block)
         else:
             # Voeg toe aan playlist
             uris = [t["uri"] for t in block]
@@ -385,8 +533,7 @@ def initial_fill(playlist_id, categorieen, history_file=None, queue_file=None,
 
             # Schrijf naar historie
             with open(history_file, "a", encoding="utf-8") as hf:
-                for t in block:
-                    hf.write(f"{t['categorie']} - {t['artiest']} - {t['titel']} - {t['uri']}\n")
+                hf.writelines(_format_history_line(t) for t in block)
 
     return {
         "toegevoegd": len(alle_tracks),
@@ -415,8 +562,7 @@ if __name__ == "__main__":
             f.write("\n".join(uris))
 
         with open(SUGGESTIONS_FILE, "w", encoding="utf-8") as f:
-            for t in block:
-                f.write(f"{t['categorie']} - {t['artiest']} - {t['titel']} - {t['uri']}\n")
+            f.writelines(_format_history_line(t) for t in block)
             f.write("\n--- KOPIEER BLOK HIERONDER ---\n")
             f.write("\n".join(uris))
 
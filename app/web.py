@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 import os
 import uuid
+import logging
+from concurrent.futures import ThreadPoolExecutor
 import threading
 import datetime
 import time
@@ -14,18 +16,45 @@ from config import (
     SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET, SPOTIFY_REDIRECT_URI,
     SPOTIFY_SCOPE, CACHE_PATH,
 )
-from suggest import get_spotify_client, initial_fill, search_spotify, generate_block, _parse_history_line
+from suggest import (
+    get_spotify_client, initial_fill, search_spotify, generate_block,
+    LockedCacheFileHandler,
+    _parse_history_line, _format_history_line,
+)
 from discovery import (
     build_taste_profile, generate_discovery_block, initial_fill_discovery,
 )
-from automation import rotate_and_regenerate
+from automation import rotate_and_regenerate, _get_all_playlist_items
 from mail import mail_configured, send_rotation_mail
 
+# LOG_LEVEL geldt alleen voor de eigen modules: spotipy logt op DEBUG
+# tokens en headers, httpx logt elke OpenAI request op INFO
+logging.basicConfig(level=logging.WARNING, format="%(message)s")
+_log_level = getattr(logging, os.getenv("LOG_LEVEL", "INFO").upper(), logging.INFO)
+for _name in ("suggest", "discovery", "automation", "mail"):
+    logging.getLogger(_name).setLevel(_log_level)
+for _name in ("spotipy", "urllib3", "httpx"):
+    logging.getLogger(_name).setLevel(logging.WARNING)
+
 app = Flask(__name__)
 
 # Voortgang bijhouden per taak
 _tasks = {}
 
+# Serialiseert load/modify/save van wissellijsten.json vanuit threads
+_config_lock = threading.Lock()
+
+
+def _set_laatste_rotatie(lijst_id, timestamp):
+    """Sla het tijdstip van de laatste rotatie op (thread-safe)."""
+    with _config_lock:
+        data = load_wissellijsten()
+        for w in data["wissellijsten"]:
+            if w["id"] == lijst_id:
+                w["laatste_rotatie"] = timestamp
+                break
+        save_wissellijsten(data)
+
 
 @app.route("/health")
 def health():
@@ -39,7 +68,7 @@ def _get_auth_manager():
         client_secret=SPOTIFY_CLIENT_SECRET,
         redirect_uri=SPOTIFY_REDIRECT_URI,
         scope=SPOTIFY_SCOPE,
-        cache_path=CACHE_PATH,
+        cache_handler=LockedCacheFileHandler(cache_path=CACHE_PATH),
         open_browser=False,
     )
 
@@ -287,17 +316,12 @@ def api_wissellijst_herstarten(lijst_id):
 
     # Playlist leeghalen
     try:
-        items = sp.playlist_items(playlist_id, fields="items(track(uri)),next",
-                                  limit=100)
+        items = _get_all_playlist_items(sp, playlist_id,
+                                        fields="items(track(uri))")
         uris = []
-        for item in items["items"]:
+        for item in items:
             if item.get("track") and item["track"].get("uri"):
                 uris.append(item["track"]["uri"])
-        while items.get("next"):
-            items = sp.next(items)
-            for item in items["items"]:
-                if item.get("track") and item["track"].get("uri"):
-                    uris.append(item["track"]["uri"])
 
         if uris:
             # Spotify max 100 per keer
@@ -483,8 +507,7 @@ def _write_queue(lijst_id, entries):
     """Schrijf wachtrij-entries naar bestand."""
     queue_file = get_queue_file(lijst_id)
     with open(queue_file, "w", encoding="utf-8") as f:
-        for t in entries:
-            f.write(f"{t['categorie']} - {t['artiest']} - {t['titel']} - {t['uri']}\n")
+        f.writelines(_format_history_line(t) for t in entries)
 
 
 @app.route("/api/wissellijsten/<lijst_id>/wachtrij")
@@ -569,12 +592,14 @@ def api_wachtrij_genereer(lijst_id):
                 )
             else:
                 max_retries = 3
+                search_cache = {}
                 for attempt in range(max_retries):
                     _tasks[task_id]["voortgang"] = 20 + (attempt * 25)
                     block = generate_block(
                         sp, wl["playlist_id"], wl.get("categorieen", []),
                         history_file=history_file,
                         max_per_artiest=wl.get("max_per_artiest", 0),
+                        search_cache=search_cache,
                     )
                     if block:
                         break
@@ -641,12 +666,7 @@ def api_roteren(lijst_id):
             _tasks[task_id]["resultaat"] = result
 
             # Update laatste rotatie in config
-            data = load_wissellijsten()
-            for i, w in enumerate(data["wissellijsten"]):
-                if w["id"] == lijst_id:
-                    data["wissellijsten"][i]["laatste_rotatie"] = datetime.datetime.now().isoformat()
-                    break
-            save_wissellijsten(data)
+            _set_laatste_rotatie(lijst_id, datetime.datetime.now().isoformat())
 
             # Stuur e-mail notificatie als ingeschakeld
             if wl.get("mail_na_rotatie") and wl.get("mail_adres") and result.get("status") == "ok":
@@ -678,6 +698,43 @@ def api_roteren(lijst_id):
 
 # --- Rotatie Scheduler ---
 
+# Max aantal geplande rotaties dat tegelijk draait
+SCHEDULER_WORKERS = 4
+
+
+def _run_scheduled_rotation(wl, now):
+    """Voer een geplande rotatie uit voor één wissellijst."""
+    print(f"[Scheduler] Rotatie starten voor: {wl['naam']}")
+    try:
+        result = rotate_and_regenerate(wl)
+
+        # Update laatste rotatie
+        _set_laatste_rotatie(wl["id"], now.isoformat())
+
+        print(f"[Scheduler] Rotatie klaar: {wl['naam']} - {result['tekst']}")
+
+        # Stuur e-mail notificatie als ingeschakeld
+        if wl.get("mail_na_rotatie") and wl.get("mail_adres") and result.get("status") == "ok":
+            print(f"[Scheduler] Rotatie-mail versturen naar {wl['mail_adres']} voor '{wl['naam']}'...", flush=True)
+            send_rotation_mail(
+                wl["mail_adres"], wl["naam"],
+                result.get("verwijderd_detail", []),
+                result.get("toegevoegd_detail", []),
+            )
+        else:
+            reason = []
+            if not wl.get("mail_na_rotatie"):
+                reason.append("mail_na_rotatie uit")
+            if not wl.get("mail_adres"):
+                reason.append("geen mail_adres")
+            if result.get("status") != "ok":
+                reason.append(f"status={result.get('status')}")
+            print(f"[Scheduler] Geen mail verstuurd voor '{wl['naam']}': {', '.join(reason)}", flush=True)
+
+    except Exception as e:
+        print(f"[Scheduler] Rotatie fout voor {wl['naam']}: {e}")
+
+
 def _check_schedules():
     """Background thread die elke 60 seconden controleert of er geroteerd moet worden."""
     while True:
@@ -685,6 +742,7 @@ def _check_schedules():
         try:
             now = datetime.datetime.now()
             data = load_wissellijsten()
+            due = []
 
             for wl in data["wissellijsten"]:
                 schema = wl.get("rotatie_schema", "uit")
@@ -747,41 +805,22 @@ def _check_schedules():
                         if now.weekday() != dag:
                             continue
 
-                # Roteer!
-                print(f"[Scheduler] Rotatie starten voor: {wl['naam']}")
-                try:
-                    result = rotate_and_regenerate(wl)
-
-                    # Update laatste rotatie
-                    wl["laatste_rotatie"] = now.isoformat()
-                    for i, w in enumerate(data["wissellijsten"]):
-                        if w["id"] == wl["id"]:
-                            data["wissellijsten"][i] = wl
-                            break
-                    save_wissellijsten(data)
-
-                    print(f"[Scheduler] Rotatie klaar: {wl['naam']} - {result['tekst']}")
-
-                    # Stuur e-mail notificatie als ingeschakeld
-                    if wl.get("mail_na_rotatie") and wl.get("mail_adres") and result.get("status") == "ok":
-                        print(f"[Scheduler] Rotatie-mail versturen naar {wl['mail_adres']} voor '{wl['naam']}'...", flush=True)
-                        send_rotation_mail(
-                            wl["mail_adres"], wl["naam"],
-                            result.get("verwijderd_detail", []),
-                            result.get("toegevoegd_detail", []),
-                        )
-                    else:
-                        reason = []
-                        if not wl.get("mail_na_rotatie"):
-                            reason.append("mail_na_rotatie uit")
-                        if not wl.get("mail_adres"):
-                            reason.append("geen mail_adres")
-                        if result.get("status") != "ok":
-                            reason.append(f"status={result.get('status')}")
-                        print(f"[Scheduler] Geen mail verstuurd voor '{wl['naam']}': {', '.join(reason)}", flush=True)
+                due.append(wl)
 
+            # Roteer! Meerdere lijsten tegelijk, zodat een trage discovery
+            # rotatie de andere lijsten niet ophoudt.
+            if due:
+                # Token eenmalig (en dus in één thread) verversen vóór de
+                # parallelle rotaties
+                try:
+                    get_spotify_client()
                 except Exception as e:
-                    print(f"[Scheduler] Rotatie fout voor {wl['naam']}: {e}")
+                    print(f"[Scheduler] Spotify auth fout: {e}")
+
+                workers = min(SCHEDULER_WORKERS, len(due))
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    for wl in due:
+                        executor.submit(_run_scheduled_rotation, wl, now)
 
         except Exception as e:
             print(f"[Scheduler] Fout: {e}")
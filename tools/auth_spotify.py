@@ -10,16 +10,27 @@ redirect_uri = os.getenv("SPOTIFY_REDIRECT_URI", "http://127.0.0.1:8888/callback
 
 scope = "playlist-read-private user-read-email"
 
-auth = SpotifyOAuth(
-    client_id=client_id,
-    client_secret=client_secret,
-    redirect_uri=redirect_uri,
-    scope=scope,
-    open_browser=True,
-    cache_path=".secrets/spotify_cache",
-)
-
-print("Opening browser for Spotify auth...")
-token = auth.get_access_token(as_dict=False)
-print("✅ Token cached to .secrets/spotify_cache")
 
+def main():
+    auth = SpotifyOAuth(
+        client_id=client_id,
+        client_secret=client_secret,
+        redirect_uri=redirect_uri,
+        scope=scope,
+        open_browser=True,
+        cache_path=".secrets/spotify_cache",
+    )
+
+    # Geldige (of via refresh token te verversen) token in de cache: geen browser nodig
+    cached = auth.validate_token(auth.cache_handler.get_cached_token())
+    if cached:
+        print("✅ Using cached token from .secrets/spotify_cache")
+        return
+
+    print("Opening browser for Spotify auth...")
+    auth.get_access_token(as_dict=False)
+    print("✅ Token cached to .secrets/spotify_cache")
+
+
+if __name__ == "__main__":
+    main()